@@ -9,13 +9,19 @@ from dash_extensions.javascript import assign, Namespace
 import warnings
 import geopandas as gpd
 import pandas as pd
+import base64
+import io
 import json
 import re
+import threading
+import uuid
+from collections import OrderedDict
 import numpy as np
 import plotly.express as px
 from components.dropdown import render_dropdown
 from components.sidebar import sidebar
 from assets.style import CONTENT_STYLE
+from utils.spatial_index import PointIndex
 
 chroma = "https://cdnjs.cloudflare.com/ajax/libs/chroma-js/2.1.0/chroma.min.js"  # js lib used for colors
 app = Dash(
@@ -31,6 +37,15 @@ dash.register_page(__name__, path="/")
 
 
 PROJECT_CRS = "EPSG:3035"
+SNAP_RADIUS_PX = 8  # pixels, furthest a map click can be from a point
+MAX_CACHED_INDEXES = 4
+MAX_ASSET_RADIUS = 1000  # metres, bounds the size of asset search results
+ASSET_COLUMN_ALIASES = {
+    "latitude": "lat",
+    "longitude": "lon",
+    "lng": "lon",
+    "long": "lon",
+}
 lat1, lon1 = 53.5286207, -0.5675306
 v_boundary_gdf = gpd.read_file(
     "src/data/EGMS_L3_100km_U_2018_2022_BOUNDARY.geojson"
@@ -132,6 +147,9 @@ def convert_json_to_geodataframe(json_dict) -> gpd.GeoDataFrame:
     GeoPandas GeoDataFrame
     """
     data = json.loads(json_dict)
+    # from_features gives no geometry column to set a CRS on
+    if not data["features"]:
+        return gpd.GeoDataFrame(geometry=[], crs=PROJECT_CRS)
     return (gpd.GeoDataFrame
             .from_features(data["features"])
             .set_crs(crs=PROJECT_CRS))
@@ -257,6 +275,52 @@ table_data = dbc.Card(
 )
 
 
+asset_lookup = dbc.Card(
+    [
+        html.H4("Upload asset list to find nearby measurement points...",
+                className="card-title"),
+        html.Div(
+            [
+                dbc.Label("Search radius (m)"),
+                dbc.Input(
+                    id="asset-radius-input",
+                    type="number",
+                    min=0,
+                    max=MAX_ASSET_RADIUS,
+                    value=50
+                ),
+                dcc.Upload(
+                    id="asset-upload",
+                    children=html.Div(["Drag and drop or select a CSV with lat/lon columns"]),
+                    style={
+                        "borderWidth": "1px",
+                        "borderStyle": "dashed",
+                        "borderRadius": "5px",
+                        "textAlign": "center",
+                        "padding": "10px",
+                        "margin": "10px 0"
+                    },
+                ),
+                html.P(id="asset-upload-message"),
+                dash_table.DataTable(
+                    id="asset-points-table",
+                    columns=[
+                        {"name": "Asset", "id": "asset"},
+                        {"name": "pid", "id": "pid"},
+                        {"name": "Distance (m)", "id": "distance"},
+                    ],
+                    sort_action="native",
+                    page_size=10,
+                    style_table={"overflowX": "auto"}
+                    ),
+            ]
+        ),
+    ],
+    body=True,
+    style={"maxWidth": "1080px"},
+)
+
+
 def plot_scatterplot(df, x_col="date", y_col="velocity"):
     """Function to plot simple plotly scatterplot"""
     fig = px.scatter(df, x=x_col, y=y_col)
@@ -285,6 +349,108 @@ def get_timeseries_from_pid(df: pd.DataFrame, pid: str) -> pd.DataFrame:
     return df[df["pid"] == pid][date_cols]
 
 
+# LRU cache of spatial indexes of loaded data, keyed by the token in
+# egms-index-key. Shared by all sessions, so guarded by a lock.
+point_indexes = OrderedDict()
+point_indexes_lock = threading.Lock()
+
+
+def cache_point_index(gdf: gpd.GeoDataFrame,
+                      index_key: str) -> PointIndex:
+    """Build a spatial index over EGMS measurement points and
+    cache it server side
+
+    Parameters
+    ----------
+    gdf : GeoDataFrame of EGMS data with easting, northing and pid columns
+    index_key : key to cache the index under
+
+    Returns
+    ----------
+    the cached PointIndex
+    """
+    index = PointIndex(gdf, crs=PROJECT_CRS, value_cols=get_date_cols(gdf))
+    with point_indexes_lock:
+        point_indexes[index_key] = index
+        point_indexes.move_to_end(index_key)
+        # Drop the least recently used indexes
+        while len(point_indexes) > MAX_CACHED_INDEXES:
+            point_indexes.popitem(last=False)
+    return index
+
+
+def evict_point_index(index_key: str):
+    """Remove a spatial index from the server side cache
+
+    Parameters
+    ----------
+    index_key : key of the cached PointIndex from egms-index-key
+    """
+    with point_indexes_lock:
+        point_indexes.pop(index_key, None)
+
+
+def get_point_index(index_key: str, stored_data: str) -> PointIndex:
+    """Return the cached spatial index for the loaded EGMS data,
+    rebuilding it from the data store if it is no longer cached
+
+    Parameters
+    ----------
+    index_key : key of the cached PointIndex from egms-index-key
+    stored_data : GeoJSON string of EGMS data from the data store
+
+    Returns
+    ----------
+    PointIndex over the measurement point easting/northing
+    """
+    with point_indexes_lock:
+        index = point_indexes.get(index_key)
+        if index is not None:
+            point_indexes.move_to_end(index_key)
+    if index is None:
+        gdf = convert_json_to_geodataframe(stored_data)
+        index = cache_point_index(gdf, index_key or uuid.uuid4().hex)
+    return index
+
+
+def parse_asset_upload(contents: str):
+    """Parse an uploaded asset list CSV
+
+    Parameters
+    ----------
+    contents : base64 encoded file contents from dcc.Upload
+
+    Returns
+    ----------
+    DataFrame of assets with numeric lat and lon columns, and
+        the number of rows dropped for missing/invalid coordinates
+
+    Raises
+    ----------
+    ValueError if the file is not a readable CSV with lat/lon columns
+    """
+    try:
+        _, content_string = contents.split(",", 1)
+        decoded = base64.b64decode(content_string).decode("utf-8")
+        df = pd.read_csv(io.StringIO(decoded))
+    except (ValueError, pd.errors.ParserError):
+        # UnicodeDecodeError and binascii.Error are ValueErrors
+        raise ValueError("Could not read file, please upload a CSV")
+    df.columns = df.columns.str.strip().str.lower()
+    df = df.rename(columns=ASSET_COLUMN_ALIASES)
+    # Keep the first of e.g. lat and latitude if both are present
+    df = df.loc[:, ~df.columns.duplicated()]
+    if not {"lat", "lon"}.issubset(df.columns):
+        raise ValueError("CSV must have lat/latitude and "
+                         "lon/lng/longitude columns")
+
+    # Drop rows pyproj can't project
+    df["lat"] = pd.to_numeric(df["lat"], errors="coerce")
+    df["lon"] = pd.to_numeric(df["lon"], errors="coerce")
+    valid = df["lat"].between(-90, 90) & df["lon"].between(-180, 180)
+    return df[valid], int((~valid).sum())
+
+
 def get_date_cols(df: pd.DataFrame, date_format: str=r"^\d{8}$"):
     """Return the date columns from a dataframe
     that match the date format pattern
@@ -306,6 +472,7 @@ app.layout = html.Div(
     [
         dcc.Store(id="intersect-tiles", storage_type="session"),
         dcc.Store(id="egms-ts-data", data=[], storage_type="session"),
+        dcc.Store(id="egms-index-key", storage_type="session"),
         dcc.Location(id="url"),
         sidebar,
         html.Div(
@@ -334,6 +501,12 @@ app.layout = html.Div(
                             ],
                             align="center",
                         ),
+                        dbc.Row(
+                            [
+                                dbc.Col(asset_lookup, md=15),
+                            ],
+                            align="center",
+                        ),
                         dbc.Row(
                             [
                                 dbc.Col(
@@ -378,6 +551,7 @@ def get_egms_tiles(direction, map_input):
 
 @callback(
     Output("egms-ts-data", "data"),
+    Output("egms-index-key", "data"),
     Output("get-data-button", "children", allow_duplicate=True),
     Output("get-data-button", "disabled", allow_duplicate=True),
     Input("get-data-button", "n_clicks"),
@@ -385,10 +559,12 @@ def get_egms_tiles(direction, map_input):
     Input("edit-control", "geojson"),
     Input("product-dropdown", "value"),
     Input("direction-dropdown", "value"),
+    State("egms-index-key", "data"),
     prevent_initial_call=True,
     allow_duplicate=True
 )
-def get_ts_data(clicks, stored_data, map_input, product, direction):
+def get_ts_data(clicks, stored_data, map_input, product, direction,
+                old_index_key):
     if clicks:
         try:
             if stored_data is None or not json.loads(stored_data)["features"]:
@@ -407,7 +583,11 @@ def get_ts_data(clicks, stored_data, map_input, product, direction):
             crs=PROJECT_CRS)
         map_gdf = convert_geojson_to_geodataframe(map_input).to_crs(PROJECT_CRS)
         data_gdf = points_in_polygon(data_gdf, map_gdf)
-        return data_gdf.to_json(), "Data Loaded", True
+        # Replace this session's previous index rather than keeping both
+        evict_point_index(old_index_key)
+        index_key = uuid.uuid4().hex
+        cache_point_index(data_gdf, index_key)
+        return data_gdf.to_json(), index_key, "Data Loaded", True
     raise PreventUpdate
 
 
@@ -418,15 +598,18 @@ def get_data_file_paths(product, direction):
 @callback(
     Output("intersect-tiles", "clear_data"),
     Output("egms-ts-data", "clear_data"),
+    Output("egms-index-key", "clear_data"),
     Output("get-data-button", "n_clicks"),
     Output("get-data-button", "disabled"),
     Output("get-data-button", "children"),
     Input("edit-control", "geojson"),
+    State("egms-index-key", "data"),
     prevent_initial_call=True
 )
-def clear_data_store(map_input):
+def clear_data_store(map_input, index_key):
     if map_input is None or not map_input["features"]:
-        return True, True, 0, False, "Get Data"
+        evict_point_index(index_key)
+        return True, True, True, 0, False, "Get Data"
     return dash.no_update
 
 
@@ -586,22 +769,114 @@ def get_point_data(click_data):
     return data.loc["pid", "properties"]
 
 
+def get_snap_distance(lat: float, zoom: float,
+                      radius_px: int=SNAP_RADIUS_PX) -> float:
+    """Convert a pixel radius on the web map to metres on the ground
+
+    Parameters
+    ----------
+    lat : latitude the radius is measured at
+    zoom : Leaflet zoom level of the map
+    radius_px : radius in screen pixels
+
+    Returns
+    ----------
+    radius in metres
+    """
+    # Web Mercator ground resolution for 256 px tiles
+    metres_per_px = 156543.03392 * np.cos(np.radians(lat)) / 2 ** zoom
+    return radius_px * metres_per_px
+
+
+def get_nearest_pid(map_click_data, index: PointIndex, zoom: float):
+    """Return the pid of the measurement point nearest
+    to a map click location
+
+    Parameters
+    ----------
+    map_click_data : Leaflet map clickData with a 'latlng' key
+    index : PointIndex over the loaded EGMS data
+    zoom : Leaflet zoom level of the map when it was clicked
+
+    Returns
+    ----------
+    pid of the nearest measurement point, or None if no point
+        lies within SNAP_RADIUS_PX pixels of the click
+    """
+    latlng = map_click_data["latlng"]
+    max_distance = get_snap_distance(latlng["lat"], zoom)
+    nearest = index.nearest(latlng["lat"], latlng["lng"], k=1)
+    if nearest.empty or nearest["distance"].iloc[0] > max_distance:
+        return None
+    return nearest["pid"].iloc[0]
+
+
 @callback(
     Output("scatterplot", "figure"),
     Input("point-data", "clickData"),
+    Input("scatter-map", "clickData"),
     Input("egms-ts-data", "data"),
+    State("egms-index-key", "data"),
+    State("scatter-map", "zoom"),
     prevent_initial_call=True
 )
-def get_ts_from_point(click_data, stored_data):
-    if click_data is not None:
+def get_ts_from_point(click_data, map_click_data, stored_data, index_key,
+                      zoom):
+    # Marker clicks carry the exact pid so take precedence over the
+    # map click that bubbles up from the same user action
+    triggered = dash.ctx.triggered_prop_ids
+    if (stored_data is None or stored_data == []
+            or not {"point-data.clickData", "scatter-map.clickData"} & set(triggered)):
+        return dash.no_update
+    index = get_point_index(index_key, stored_data)
+    pid = None
+    if "point-data.clickData" in triggered and click_data is not None:
         pid = get_point_data(click_data)
-        gdf = convert_json_to_geodataframe(stored_data)
-        ts_df = get_timeseries_from_pid(gdf, pid)
+    elif "scatter-map.clickData" in triggered and map_click_data is not None:
+        pid = get_nearest_pid(map_click_data, index, zoom)
+    if pid is not None:
+        ts_df = get_timeseries_from_pid(index.get_rows(pid), pid)
         lng_df = pd.melt(ts_df, var_name="date", value_name="velocity")
         print(lng_df)
         return plot_scatterplot(lng_df)
     return dash.no_update
 
 
+@callback(
+    Output("asset-points-table", "data"),
+    Output("asset-upload-message", "children"),
+    Input("asset-upload", "contents"),
+    Input("asset-radius-input", "value"),
+    Input("egms-ts-data", "data"),
+    State("egms-index-key", "data"),
+    prevent_initial_call=True
+)
+def get_points_near_assets(contents, radius, stored_data, index_key):
+    if contents is None:
+        return [], ""
+    if stored_data is None or stored_data == []:
+        return [], "Load data for an AOI before searching for assets"
+    if radius is None or not 0 <= radius <= MAX_ASSET_RADIUS:
+        return [], f"Radius must be between 0 and {MAX_ASSET_RADIUS} m"
+    try:
+        assets_df, n_invalid = parse_asset_upload(contents)
+    except ValueError as e:
+        return [], str(e)
+    if assets_df.empty:
+        return [], "No assets with valid lat/lon values found"
+    index = get_point_index(index_key, stored_data)
+    matches = index.within_radius(
+        assets_df["lat"].to_numpy(), assets_df["lon"].to_numpy(), radius)
+    asset_names = (assets_df["name"] if "name" in assets_df.columns
+                   else assets_df.index.to_series())
+    matches["asset"] = asset_names.to_numpy()[matches["query"]]
+    matches["distance"] = matches["distance"].round(1)
+    message = (f"{matches['pid'].nunique()} measurement points within "
+               f"{radius} m of {len(assets_df)} assets")
+    if n_invalid:
+        message += f" ({n_invalid} rows skipped with invalid lat/lon)"
+    return matches[["asset", "pid", "distance"]].to_dict("records"), message
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+
+
+class PointIndex:
+    """KD-tree index over EGMS measurement point locations
+
+    Points are indexed on their projected easting/northing so that
+    distances are in metres and lookups stay exact regardless of how
+    (or whether) the points are drawn on the map. The pid and
+    value_cols of each point are kept alongside the tree so a resolved
+    pid can be looked up without re-reading the dataset.
+
+    Parameters
+    ----------
+    df : pandas DataFrame with easting, northing and pid columns
+    crs : a string denoting the CRS of the easting/northing values
+    value_cols : columns of df to keep for looking up by pid
+    """
+
+    def __init__(self, df: pd.DataFrame, crs: str="EPSG:3035",
+                 value_cols: list=[]):
+        # An AOI with no measurement points has none of these columns
+        df = df.reindex(columns=df.columns.union(
+            ["pid", "easting", "northing"], sort=False))
+        self.data = df[["pid", *value_cols]].reset_index(drop=True)
+        self.pids = df["pid"].to_numpy()
+        self.positions = {pid: i for i, pid in enumerate(self.pids)}
+        self.coords = df[["easting", "northing"]].to_numpy(dtype=float)
+        self.tree = cKDTree(self.coords) if len(df) else None
+        self.transformer = Transformer.from_crs(
+            "EPSG:4326", crs, always_xy=True)
+
+    def __len__(self):
+        return len(self.pids)
+
+    def get_rows(self, pid) -> pd.DataFrame:
+        """Return the pid and value_cols row for a pid
+
+        Parameters
+        ----------
+        pid : pid value of the measurement point
+
+        Returns
+        ----------
+        DataFrame with the pid's row, empty if pid is not indexed
+        """
+        position = self.positions.get(pid)
+        if position is None:
+            return self.data.iloc[[]]
+        return self.data.iloc[[position]]
+
+    def to_projected(self, lat, lon) -> np.ndarray:
+        """Project lat/lon values into the index CRS
+
+        Parameters
+        ----------
+        lat : latitude value or array of values
+        lon : longitude value or array of values
+
+        Returns
+        ----------
+        (n, 2) array of easting/northing values
+        """
+        x, y = self.transformer.transform(np.atleast_1d(lon),
+                                          np.atleast_1d(lat))
+        return np.column_stack([x, y])
+
+    def nearest(self, lat: float, lon: float, k: int=1) -> pd.DataFrame:
+        """Return the k nearest measurement points to a lat/lon
+
+        Parameters
+        ----------
+        lat : latitude of the query location
+        lon : longitude of the query location
+        k : number of nearest points to return
+
+        Returns
+        ----------
+        DataFrame of pid and distance (metres), ordered by distance
+        """
+        if len(self) == 0:
+            return pd.DataFrame({"pid": self.pids,
+                                 "distance": np.empty(0)})
+        k = min(k, len(self))
+        dist, idx = self.tree.query(self.to_projected(lat, lon)[0], k=k)
+        return pd.DataFrame({"pid": self.pids[np.atleast_1d(idx)],
+                             "distance": np.atleast_1d(dist)})
+
+    def within_radius(self, lat, lon, radius: float) -> pd.DataFrame:
+        """Return all measurement points within a radius of
+        one or more lat/lon locations
+
+        Parameters
+        ----------
+        lat : latitude value or array of values
+        lon : longitude value or array of values
+        radius : search radius in metres
+
+        Returns
+        ----------
+        DataFrame of query (position of the input location), pid
+            and distance (metres), ordered by query then distance
+        """
+        if len(self) == 0:
+            return pd.DataFrame({"query": np.empty(0, dtype=int),
+                                 "pid": self.pids,
+                                 "distance": np.empty(0)})
+        query_coords = self.to_projected(lat, lon)
+        matches = self.tree.query_ball_point(query_coords, r=radius)
+        query_idx = np.repeat(np.arange(len(matches)),
+                              [len(m) for m in matches])
+        point_idx = np.fromiter(
+            (i for m in matches for i in m), dtype=int, count=len(query_idx))
+        dist = np.linalg.norm(
+            self.coords[point_idx] - query_coords[query_idx], axis=1)
+        return (pd.DataFrame({"query": query_idx,
+                              "pid": self.pids[point_idx],
+                              "distance": dist})
+                .sort_values(["query", "distance"])
+                .reset_index(drop=True))